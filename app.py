@@ -1,17 +1,22 @@
 import os
 import uuid
-from datetime import datetime
+from datetime import datetime, date
 from uuid import uuid4, UUID
 from functools import wraps
 
+import click
+import jwt
 import stripe
 import requests
-from flask import Flask, jsonify, render_template, render_template_string, request, redirect, url_for
+from flask import Flask, g, jsonify, render_template, render_template_string, request, redirect, url_for
 from sqlalchemy import text
 from sqlalchemy.exc import IntegrityError, SQLAlchemyError
 
 from models import db, User, Profile, PSPCondition, UserPSP, UserPSPCondition
 from config import Config
+import partitions
+from psp_catalog import PSPCatalog, install_version_counter
+from db_routing import ReplicaRouter, read_only, mark_write, primary, on_replica
 from supabase import create_client
 
 # -----------------------
@@ -35,11 +40,11 @@ supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
 # -----------------------
 # Fix connessione Supabase (fallback IPv6 -> IPv4)
 # -----------------------
-def force_ipv4_db_uri(uri: str) -> str:
+def force_ipv4_db_uri(uri: str, session_attrs: str = "read-write") -> str:
     if not uri:
         return uri
     if "supabase.co" in uri and "?" not in uri:
-        return uri + "?sslmode=require&target_session_attrs=read-write&options=-c%20inet_family=inet"
+        return uri + f"?sslmode=require&target_session_attrs={session_attrs}&options=-c%20inet_family=inet"
     return uri
 
 patched_uri = force_ipv4_db_uri(app.config.get("SQLALCHEMY_DATABASE_URI"))
@@ -47,12 +52,22 @@ if patched_uri != app.config.get("SQLALCHEMY_DATABASE_URI"):
     print("🔧 Patch DB URI per IPv4:", patched_uri)
     app.config["SQLALCHEMY_DATABASE_URI"] = patched_uri
 
+# Le replica sono in standby: non possono soddisfare target_session_attrs=read-write
+app.config["SQLALCHEMY_REPLICA_URIS"] = [
+    force_ipv4_db_uri(u, session_attrs="any") for u in app.config.get("SQLALCHEMY_REPLICA_URIS", [])
+]
+replica_router = ReplicaRouter(app)
+
 # Log DB uri utile per debug
 print(f"🔧 SQLALCHEMY_DATABASE_URI: {app.config.get('SQLALCHEMY_DATABASE_URI')}")
+print(f"🔧 Read replica configurate: {len(app.config['SQLALCHEMY_REPLICA_URIS'])}")
 
 # Costanti
 CIRCUITS = ['Visa', 'Mastercard', 'Amex', 'Diners']
 
+# Catalogo PSP + abilitazioni merchant in memoria di processo
+psp_catalog = PSPCatalog(ttl=app.config.get("PSP_CATALOG_TTL", 5))
+
 # -----------------------
 # Helper DB / util
 # -----------------------
@@ -130,6 +145,7 @@ def dashboard():
     return render_template(
         "dashboard.html",
         email=email,
+        include_archived=wants_archived(),
         supabase_url=app.config.get('SUPABASE_URL'),
         supabase_key=app.config.get('SUPABASE_ANON_KEY')
     )
@@ -138,15 +154,12 @@ def dashboard():
 # API PSP disponibili
 # -----------------------
 @app.get('/api/psps')
+@read_only
 def list_psps():
-    psps = PSPCondition.query.filter_by(active=True).order_by(PSPCondition.psp_name.asc()).all()
-    return jsonify([{
-        'id': str(p.id),
-        'psp_name': p.psp_name,
-        'fixed_fee': float(p.fixed_fee or 0),
-        'percentage_fee': float(p.percentage_fee or 0),
-        'currency': p.currency or 'EUR'
-    } for p in psps])
+    snap = psp_catalog.snapshot()
+    resp = app.response_class(snap.active_json, mimetype="application/json")
+    resp.set_etag(snap.etag)
+    return resp.make_conditional(request)
 
 # -----------------------
 # Checkout core endpoints
@@ -159,15 +172,9 @@ def create_transaction():
         if k not in data:
             return jsonify({"error": f"{k} mancante"}), 400
 
-    exists = db.session.execute(
-        text("""
-            SELECT 1 FROM user_psp u
-            JOIN psp_conditions c ON u.psp_name = c.psp_name
-            WHERE u.user_id = :uid AND c.id = :pid
-            LIMIT 1
-        """),
-        {"uid": data["user_id"], "pid": data["psp_id"]}
-    ).scalar()
+    # Ogni esito scrive una transazione: le letture successive restano sul primario
+    mark_write()
+    exists = psp_catalog.is_enabled(data["user_id"], psp_id=data["psp_id"])
 
     if not exists:
         # Inserimento transazione fallita
@@ -226,10 +233,15 @@ def create_transaction():
 
 
 @app.get("/api/transaction-status/<tx_id>")
+@read_only
 def transaction_status(tx_id):
     try:
         q = text("SELECT id, created_at FROM transactions WHERE id = :id")
         row = db.session.execute(q, {"id": tx_id}).mappings().first()
+        if not row and on_replica():
+            # La replica potrebbe non aver ancora ricevuto la transazione
+            with primary():
+                row = db.session.execute(q, {"id": tx_id}).mappings().first()
         if not row:
             return jsonify({"error": "Transazione non trovata"}), 404
         return jsonify({"id": row["id"], "created_at": str(row["created_at"])})
@@ -237,6 +249,114 @@ def transaction_status(tx_id):
         app.logger.exception("Errore transaction_status")
         return jsonify({"error": "Errore nel recupero stato transazione"}), 500
 
+# -----------------------
+# Storico transazioni (dashboard / export), con mesi archiviati su richiesta
+# -----------------------
+def wants_archived() -> bool:
+    return request.args.get("include_archived", "").lower() in ("1", "true", "yes")
+
+def load_user_transactions(user_id: str, include_archived: bool, since: date = None):
+    params = {"uid": user_id}
+    sql = "SELECT * FROM transactions WHERE user_id = :uid"
+    if since:
+        sql += " AND created_at >= :since"
+        params["since"] = since
+    live = db.session.execute(text(sql + " ORDER BY created_at"), params).mappings().all()
+    archived = []
+    if include_archived:
+        # Senza `since` esplicito l'archivio si legge solo per una finestra limitata
+        archive_since = since or partitions.add_months(
+            partitions.month_start(date.today()),
+            -app.config.get("TRANSACTIONS_ARCHIVE_DEFAULT_MONTHS", 24)
+        )
+        archived = partitions.read_archived_transactions(
+            app.config.get("TRANSACTIONS_ARCHIVE_DIR"), archive_since, user_id=user_id
+        )
+    return partitions.merge_transactions(live, archived, partitions.transaction_column_types())
+
+def require_supabase_user(view):
+    """Richiede il JWT Supabase del chiamante (Authorization: Bearer) e mette in g.user_id
+    l'id di public.users corrispondente.
+
+    Queste route leggono con il ruolo del server (niente RLS): l'utente si ricava
+    dal token. Il sub del token è l'id di auth.users, mentre transactions.user_id
+    punta a public.users.id: il collegamento passa dall'email verificata nel token.
+    Un eventuale ?user_id= deve coincidere.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        secret = app.config.get("SUPABASE_JWT_SECRET")
+        auth = request.headers.get("Authorization", "")
+        if not secret or not auth.startswith("Bearer "):
+            return jsonify({"error": "Autenticazione richiesta"}), 401
+        try:
+            claims = jwt.decode(auth[7:], secret, algorithms=["HS256"], audience="authenticated")
+            email = claims["email"].strip().lower()
+        except (jwt.PyJWTError, KeyError, AttributeError):
+            return jsonify({"error": "Token non valido"}), 401
+        if not email:
+            return jsonify({"error": "Token non valido"}), 401
+
+        user_id = db.session.execute(
+            text("SELECT id FROM users WHERE lower(email) = :email LIMIT 1"),
+            {"email": email}
+        ).scalar()
+        if not user_id:
+            return jsonify({"error": "Utente non trovato"}), 403
+        user_id = str(user_id)
+
+        requested = request.args.get("user_id")
+        if requested:
+            try:
+                if str(UUID(requested)) != user_id:
+                    return jsonify({"error": "Accesso negato"}), 403
+            except ValueError:
+                return jsonify({"error": "user_id non valido"}), 400
+        g.user_id = user_id
+        return view(*args, **kwargs)
+    return wrapper
+
+def parse_since():
+    raw = request.args.get("since")
+    if not raw:
+        return None
+    return datetime.strptime(raw, "%Y-%m").date()
+
+@app.get("/api/transactions")
+@require_supabase_user
+@read_only
+def list_transactions():
+    user_id = g.user_id
+    try:
+        since = parse_since()
+    except ValueError:
+        return jsonify({"error": "since non valido (formato YYYY-MM)"}), 400
+    try:
+        return jsonify(load_user_transactions(user_id, wants_archived(), since))
+    except Exception:
+        app.logger.exception("Errore list_transactions")
+        return jsonify({"error": "Errore nel recupero transazioni"}), 500
+
+@app.get("/api/transactions/export")
+@require_supabase_user
+@read_only
+def export_transactions():
+    user_id = g.user_id
+    try:
+        since = parse_since()
+    except ValueError:
+        return jsonify({"error": "since non valido (formato YYYY-MM)"}), 400
+    try:
+        rows = load_user_transactions(user_id, wants_archived(), since)
+    except Exception:
+        app.logger.exception("Errore export_transactions")
+        return jsonify({"error": "Errore export transazioni"}), 500
+    return app.response_class(
+        partitions.rows_to_csv(rows),
+        mimetype="text/csv",
+        headers={"Content-Disposition": "attachment; filename=transazioni.csv"}
+    )
+
 @app.post("/webhook/<psp_name>")
 def webhook(psp_name):
     payload = request.get_json(silent=True) or {}
@@ -251,7 +371,8 @@ def webhook(psp_name):
     if ok:
         return jsonify({"message": "Aggiornato"}), 200
     else:
-        return jsonify({"warning": "Unable to update (status column may be missing)"}), 200
+        # Non-2xx: il PSP deve ritentare, altrimenti l'aggiornamento va perso
+        return jsonify({"error": "Impossibile aggiornare lo stato, riprovare"}), 503
 
 # -----------------------
 # Stripe / PayPal helpers
@@ -423,13 +544,8 @@ def simulate_pay():
             ), 400
 
         try:
-            # Recupera il PSP abilitato per l'utente tramite ORM
-            user_psp = UserPSP.query.join(PSPCondition).filter(
-                UserPSP.user_id == user_id,
-                PSPCondition.psp_name == psp_name
-            ).first()
-
-            if not user_psp:
+            # Verifica abilitazione dal catalogo in memoria (nessun round trip DB)
+            if not psp_catalog.is_enabled(user_id, psp_name=psp_name):
                 return render_template("simulate-pay.html",
                     psp=psp_name,
                     amount=amount_raw,
@@ -443,7 +559,7 @@ def simulate_pay():
             tx = UserPSPCondition(
                    id=str(uuid4()),
                    user_id=user_id,
-                   psp_id=user_psp.psp_id,
+                   psp_id=psp_catalog.psp_id_for(psp_name),
                    amount=amount,
                    currency="EUR",
                    created_at=datetime.utcnow(),
@@ -605,6 +721,32 @@ def payment_return():
 
     return "PSP non supportato", 400
 
+# -----------------------
+# CLI manutenzione transazioni
+# -----------------------
+@app.cli.command("transactions-partition")
+@click.option("--ahead", default=3, show_default=True, help="Mesi futuri da pre-creare")
+def transactions_partition_cmd(ahead):
+    """Migra transactions a partizioni mensili (o crea le partizioni mancanti)."""
+    created = partitions.migrate_to_partitioned(ahead)
+    print(f"✅ Partizioni create: {', '.join(created) or 'nessuna'}")
+
+@app.cli.command("transactions-archive")
+@click.option("--months", default=None, type=int, help="Archivia partizioni più vecchie di N mesi")
+@click.option("--drop", is_flag=True, help="Elimina le partizioni dopo averle staccate")
+def transactions_archive_cmd(months, drop):
+    """Esporta su disco (CSV gzip) e stacca le partizioni vecchie."""
+    if months is None:
+        months = app.config.get("TRANSACTIONS_ARCHIVE_AFTER_MONTHS")
+    archived = partitions.archive_partitions(months, app.config.get("TRANSACTIONS_ARCHIVE_DIR"), drop=drop)
+    print(f"📦 Archiviati: {', '.join(archived) or 'nessun mese'}")
+
+@app.cli.command("psp-catalog-install")
+def psp_catalog_install_cmd():
+    """Installa il contatore di versione del catalogo PSP (tabella + trigger)."""
+    install_version_counter()
+    print("✅ catalog_version e trigger installati")
+
 # -----------------------
 # Avvio app (sviluppo)
 # -----------------------
@@ -13,6 +13,20 @@ class Config:
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL', '').replace('postgres://', 'postgresql://')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+    # Read replica (opzionali): URI separate da virgola, usate dalle route in sola lettura
+    SQLALCHEMY_REPLICA_URIS = [
+        u.strip().replace('postgres://', 'postgresql://')
+        for u in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if u.strip()
+    ]
+    REPLICA_MAX_LAG_SECONDS = float(os.environ.get('REPLICA_MAX_LAG_SECONDS', '5'))
+    # Uno standby che non riceve nulla dal primario da più di così è considerato scollegato
+    REPLICA_MAX_SILENCE_SECONDS = float(os.environ.get('REPLICA_MAX_SILENCE_SECONDS', '60'))
+    REPLICA_CONNECT_TIMEOUT_SECONDS = int(os.environ.get('REPLICA_CONNECT_TIMEOUT_SECONDS', '2'))
+    REPLICA_STATEMENT_TIMEOUT_MS = int(os.environ.get('REPLICA_STATEMENT_TIMEOUT_MS', '5000'))
+    REPLICA_LAG_CHECK_SECONDS = float(os.environ.get('REPLICA_LAG_CHECK_SECONDS', '2'))
+    # Dopo una scrittura il client legge dal primario per questo intervallo
+    REPLICA_STICKY_SECONDS = float(os.environ.get('REPLICA_STICKY_SECONDS', '10'))
+
     # URL base dell'app (es. per redirect dopo pagamento)
     BASE_URL = os.environ.get('BASE_URL', 'https://neksas-activation.onrender.com')
 
@@ -23,3 +37,12 @@ class Config:
     PAYPAL_CLIENT_ID = os.environ.get('PAYPAL_CLIENT_ID', '')
     PAYPAL_SECRET = os.environ.get('PAYPAL_SECRET', '')
     PAYPAL_MODE = os.environ.get('PAYPAL_MODE', 'sandbox')  # oppure 'live'
+
+    # Archivio transazioni (partizioni mensili staccate ed esportate su disco)
+    TRANSACTIONS_ARCHIVE_DIR = os.environ.get('TRANSACTIONS_ARCHIVE_DIR', 'archive')
+    TRANSACTIONS_ARCHIVE_AFTER_MONTHS = int(os.environ.get('TRANSACTIONS_ARCHIVE_AFTER_MONTHS', '12'))
+    # Finestra di mesi archiviati letti quando la richiesta non indica `since`
+    TRANSACTIONS_ARCHIVE_DEFAULT_MONTHS = int(os.environ.get('TRANSACTIONS_ARCHIVE_DEFAULT_MONTHS', '24'))
+
+    # Catalogo PSP in memoria: ogni quanti secondi verificare la versione sul DB
+    PSP_CATALOG_TTL = float(os.environ.get('PSP_CATALOG_TTL', '5'))
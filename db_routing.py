@@ -0,0 +1,179 @@
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from flask import current_app, g, has_app_context, request
+from flask_sqlalchemy.session import Session as FlaskSession
+from sqlalchemy import create_engine, event, text
+
+# -----------------------
+# Routing letture su read replica
+# -----------------------
+# Le route marcate con @read_only eseguono le query di db.session su una
+# replica sana (lag sotto REPLICA_MAX_LAG_SECONDS); in ogni altro caso, o se
+# nessuna replica è disponibile, si resta sul primario. Dopo una scrittura il
+# client viene "incollato" al primario per REPLICA_STICKY_SECONDS tramite
+# cookie, così le letture successive vedono le proprie scritture.
+
+STICKY_COOKIE = "db_primary_until"
+
+# NULL = replica non sana: uno standby senza WAL receiver in streaming (o
+# muto da troppo) ha rigiocato tutto ciò che ha e riporterebbe lag 0.
+LAG_SQL = text("""
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN NOT EXISTS (
+            SELECT 1 FROM pg_stat_wal_receiver
+            WHERE status = 'streaming'
+              AND last_msg_receipt_time > now() - make_interval(secs => :max_silence)
+        ) THEN NULL
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END
+""")
+
+
+class RoutingSession(FlaskSession):
+    """Session che usa l'engine di replica scelto per la richiesta, se presente."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and has_app_context():
+            engine = g.get("db_replica_engine")
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+class _Replica:
+    def __init__(self, uri: str, connect_timeout: int, statement_timeout_ms: int):
+        self.uri = uri
+        # Una replica irraggiungibile deve far fallire in fretta, non appendere la richiesta
+        self.engine = create_engine(
+            uri, pool_pre_ping=True, pool_timeout=connect_timeout,
+            connect_args={"connect_timeout": connect_timeout}
+        )
+        event.listen(self.engine, "connect", self._set_statement_timeout(statement_timeout_ms))
+        self.lag = None
+        self.checked_at = 0.0
+
+    @staticmethod
+    def _set_statement_timeout(ms: int):
+        def listener(dbapi_conn, _record):
+            cur = dbapi_conn.cursor()
+            cur.execute(f"SET statement_timeout = {int(ms)}")
+            cur.close()
+            # commit: altrimenti il rollback del pool annullerebbe il SET
+            dbapi_conn.commit()
+        return listener
+
+
+class ReplicaRouter:
+    def __init__(self, app=None):
+        self._replicas = []
+        self._cycle = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self._replicas = [
+            _Replica(
+                uri,
+                connect_timeout=int(app.config.get("REPLICA_CONNECT_TIMEOUT_SECONDS", 2)),
+                statement_timeout_ms=int(app.config.get("REPLICA_STATEMENT_TIMEOUT_MS", 5000))
+            )
+            for uri in app.config.get("SQLALCHEMY_REPLICA_URIS", [])
+        ]
+        self._cycle = itertools.cycle(range(len(self._replicas))) if self._replicas else None
+        app.extensions["db_replicas"] = self
+        app.after_request(self._set_sticky_cookie)
+
+    # -----------------------
+    # Scelta replica
+    # -----------------------
+    def _lag_ok(self, replica: _Replica) -> bool:
+        cfg = current_app.config
+        # Una sola sonda alla volta per replica: chi arriva nel frattempo usa
+        # l'ultimo esito noto (all'avvio None -> primario) invece di bloccarsi.
+        with self._lock:
+            due = time.monotonic() - replica.checked_at >= cfg.get("REPLICA_LAG_CHECK_SECONDS", 2)
+            if due:
+                replica.checked_at = time.monotonic()
+        if due:
+            try:
+                with replica.engine.connect() as conn:
+                    lag = conn.execute(
+                        LAG_SQL, {"max_silence": cfg.get("REPLICA_MAX_SILENCE_SECONDS", 60)}
+                    ).scalar()
+                replica.lag = None if lag is None else float(lag)
+                if replica.lag is None:
+                    current_app.logger.warning("Replica non in streaming: %s", replica.engine.url.host)
+            except Exception:
+                current_app.logger.exception("Replica non raggiungibile: %s", replica.engine.url.host)
+                replica.lag = None
+        return replica.lag is not None and replica.lag <= cfg.get("REPLICA_MAX_LAG_SECONDS", 5)
+
+    def pick(self):
+        """Engine di una replica sana (round robin), oppure None per il primario."""
+        if not self._replicas:
+            return None
+        with self._lock:
+            order = [next(self._cycle) for _ in self._replicas]
+        for idx in order:
+            replica = self._replicas[idx]
+            if self._lag_ok(replica):
+                return replica.engine
+        current_app.logger.warning("Nessuna replica entro il lag massimo -> fallback primario")
+        return None
+
+    # -----------------------
+    # Read-your-own-writes
+    # -----------------------
+    def _set_sticky_cookie(self, response):
+        if g.get("db_wrote"):
+            sticky = current_app.config.get("REPLICA_STICKY_SECONDS", 10)
+            response.set_cookie(
+                STICKY_COOKIE, str(time.time() + sticky),
+                max_age=int(sticky) + 1, httponly=True, samesite="Lax"
+            )
+        return response
+
+
+def pinned_to_primary() -> bool:
+    try:
+        return float(request.cookies.get(STICKY_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+
+def mark_write():
+    """Segnala che la richiesta ha scritto sul primario: il client resta sul primario per un po'."""
+    g.db_wrote = True
+
+
+def read_only(view):
+    """Instrada le query della route su una replica, se configurata e aggiornata."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        router = current_app.extensions.get("db_replicas")
+        if router is not None and not pinned_to_primary():
+            g.db_replica_engine = router.pick()
+        return view(*args, **kwargs)
+    return wrapper
+
+
+@contextmanager
+def primary():
+    """Forza il primario all'interno del blocco (es. retry dopo un miss sulla replica)."""
+    previous = g.pop("db_replica_engine", None)
+    try:
+        yield
+    finally:
+        if previous is not None:
+            g.db_replica_engine = previous
+
+
+def on_replica() -> bool:
+    return has_app_context() and g.get("db_replica_engine") is not None
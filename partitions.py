@@ -0,0 +1,454 @@
+import csv
+import glob
+import gzip
+import io
+import os
+import re
+import time
+from datetime import date, datetime
+from uuid import UUID
+
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+from models import db
+
+# -----------------------
+# Partizionamento mensile di `transactions` su created_at
+# -----------------------
+PARENT_TABLE = "transactions"
+LEGACY_TABLE = "transactions_legacy"
+DEFAULT_PARTITION = "transactions_default"
+PARTITION_RE = re.compile(r"^transactions_p(\d{4})(\d{2})$")
+ARCHIVE_RE = re.compile(r"^transactions_(\d{4})(\d{2})\.csv\.gz$")
+
+
+def month_start(d: date) -> date:
+    return date(d.year, d.month, 1)
+
+
+def add_months(d: date, n: int) -> date:
+    idx = d.year * 12 + (d.month - 1) + n
+    return date(idx // 12, idx % 12 + 1, 1)
+
+
+def partition_name(month: date) -> str:
+    return f"{PARENT_TABLE}_p{month.year:04d}{month.month:02d}"
+
+
+def archive_file_name(month: date) -> str:
+    return f"{PARENT_TABLE}_{month.year:04d}{month.month:02d}.csv.gz"
+
+
+def is_partitioned() -> bool:
+    q = text("""
+        SELECT 1 FROM pg_partitioned_table pt
+        JOIN pg_class c ON c.oid = pt.partrelid
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE n.nspname = 'public' AND c.relname = :table
+    """)
+    return bool(db.session.execute(q, {"table": PARENT_TABLE}).scalar())
+
+
+def list_partitions() -> list:
+    """Restituisce i mesi (date al giorno 1) delle partizioni attaccate, in ordine."""
+    q = text("""
+        SELECT c.relname FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        JOIN pg_class p ON p.oid = i.inhparent
+        WHERE p.relname = :table
+    """)
+    months = []
+    for name in db.session.execute(q, {"table": PARENT_TABLE}).scalars():
+        m = PARTITION_RE.match(name)
+        if m:
+            months.append(date(int(m.group(1)), int(m.group(2)), 1))
+    return sorted(months)
+
+
+def _roles_present(*roles) -> list:
+    q = text("SELECT rolname FROM pg_roles WHERE rolname = ANY(:roles)")
+    return list(db.session.execute(q, {"roles": list(roles)}).scalars())
+
+
+def _lock_down(table: str):
+    """RLS senza policy + revoca ai ruoli Supabase: una partizione non deve essere
+    leggibile/scrivibile direttamente via PostgREST, solo attraverso il padre."""
+    db.session.execute(text(f"ALTER TABLE {table} ENABLE ROW LEVEL SECURITY"))
+    for role in _roles_present("anon", "authenticated"):
+        db.session.execute(text(f'REVOKE ALL ON {table} FROM "{role}"'))
+
+
+def ensure_partition(month: date) -> bool:
+    """Crea la partizione del mese indicato se manca. Ritorna True se creata.
+
+    Le righe del mese eventualmente finite nella partizione di default vengono
+    spostate nella nuova partizione (Postgres rifiuta altrimenti l'ATTACH).
+    """
+    month = month_start(month)
+    if month in list_partitions():
+        return False
+    name = partition_name(month)
+    params = {"start": month, "end": add_months(month, 1)}
+    db.session.execute(text(f"CREATE TABLE {name} (LIKE {PARENT_TABLE} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)"))
+    _lock_down(name)
+    db.session.execute(text(f"""
+        WITH moved AS (
+            DELETE FROM {DEFAULT_PARTITION}
+            WHERE created_at >= :start AND created_at < :end
+            RETURNING *
+        )
+        INSERT INTO {name} SELECT * FROM moved
+    """), params)
+    db.session.execute(text(
+        f"ALTER TABLE {PARENT_TABLE} ATTACH PARTITION {name} "
+        f"FOR VALUES FROM ('{params['start'].isoformat()}') TO ('{params['end'].isoformat()}')"
+    ))
+    return True
+
+
+def ensure_upcoming_partitions(ahead: int = 3, today: date = None) -> list:
+    """Garantisce le partizioni dal mese corrente fino a `ahead` mesi in avanti."""
+    current = month_start(today or date.today())
+    created = []
+    for i in range(ahead + 1):
+        month = add_months(current, i)
+        if ensure_partition(month):
+            created.append(partition_name(month))
+    db.session.commit()
+    return created
+
+
+def _check_no_inbound_fks():
+    q = text("""
+        SELECT conname, conrelid::regclass::text FROM pg_constraint
+        WHERE contype = 'f' AND confrelid = to_regclass(:table)
+    """)
+    fks = db.session.execute(q, {"table": f"public.{PARENT_TABLE}"}).all()
+    if fks:
+        refs = ", ".join(f"{table}.{name}" for name, table in fks)
+        raise RuntimeError(
+            f"{PARENT_TABLE} è referenziata da foreign key ({refs}): "
+            "rimuoverle prima della migrazione, una tabella partizionata non le può ereditare"
+        )
+
+
+def _copy_grants():
+    """Allinea i GRANT del nuovo padre a quelli della legacy (inclusi anon/authenticated)."""
+    acl_sql = """
+        SELECT CASE WHEN a.grantee = 0 THEN 'PUBLIC' ELSE quote_ident(r.rolname) END, a.privilege_type
+        FROM pg_class c
+        CROSS JOIN LATERAL aclexplode(c.relacl) a
+        LEFT JOIN pg_roles r ON r.oid = a.grantee
+        WHERE c.oid = to_regclass(:table) AND a.grantee <> c.relowner
+    """
+    # prima via i privilegi di default assegnati alla nuova tabella...
+    for grantee in set(db.session.execute(text(acl_sql), {"table": f"public.{PARENT_TABLE}"}).scalars()):
+        db.session.execute(text(f"REVOKE ALL ON {PARENT_TABLE} FROM {grantee}"))
+    # ...poi esattamente quelli della tabella originale
+    for grantee, privilege in db.session.execute(text(acl_sql), {"table": f"public.{LEGACY_TABLE}"}).all():
+        db.session.execute(text(f"GRANT {privilege} ON {PARENT_TABLE} TO {grantee}"))
+
+
+def _copy_rls():
+    flags = db.session.execute(text("""
+        SELECT relrowsecurity, relforcerowsecurity FROM pg_class WHERE oid = to_regclass(:table)
+    """), {"table": f"public.{LEGACY_TABLE}"}).first()
+    if flags[0]:
+        db.session.execute(text(f"ALTER TABLE {PARENT_TABLE} ENABLE ROW LEVEL SECURITY"))
+    if flags[1]:
+        db.session.execute(text(f"ALTER TABLE {PARENT_TABLE} FORCE ROW LEVEL SECURITY"))
+
+    policies = db.session.execute(text("""
+        SELECT quote_ident(policyname), permissive, cmd, qual, with_check,
+               ARRAY(SELECT CASE WHEN r = 'public' THEN 'PUBLIC' ELSE quote_ident(r) END FROM unnest(roles) r)
+        FROM pg_policies WHERE schemaname = 'public' AND tablename = :table
+    """), {"table": LEGACY_TABLE}).all()
+    for name, permissive, cmd, qual, with_check, roles in policies:
+        sql = f"CREATE POLICY {name} ON {PARENT_TABLE} AS {permissive} FOR {cmd} TO {', '.join(roles)}"
+        if qual:
+            sql += f" USING ({qual})"
+        if with_check:
+            sql += f" WITH CHECK ({with_check})"
+        db.session.execute(text(sql))
+
+
+def _copy_triggers():
+    triggers = db.session.execute(text("""
+        SELECT pg_get_triggerdef(oid) FROM pg_trigger
+        WHERE tgrelid = to_regclass(:table) AND NOT tgisinternal
+    """), {"table": f"public.{LEGACY_TABLE}"}).scalars()
+    # pg_get_triggerdef qualifica lo schema solo se la tabella non è nel search_path
+    target = re.compile(rf" ON (public\.)?{LEGACY_TABLE} ")
+    for ddl in triggers:
+        db.session.execute(text(target.sub(f" ON public.{PARENT_TABLE} ", ddl, count=1)))
+
+
+def _copy_publications():
+    pubs = db.session.execute(text("""
+        SELECT quote_ident(pubname) FROM pg_publication_tables
+        WHERE schemaname = 'public' AND tablename = :table
+    """), {"table": LEGACY_TABLE}).scalars()
+    for pub in pubs:
+        db.session.execute(text(f"ALTER PUBLICATION {pub} ADD TABLE {PARENT_TABLE}"))
+
+
+def migrate_to_partitioned(ahead: int = 3) -> list:
+    """Converte `transactions` in tabella partizionata per mese su created_at.
+
+    La tabella originale viene rinominata in `transactions_legacy` e i dati
+    copiati nelle partizioni. La legacy resta in piedi, non modificata, finché
+    non viene verificata e rimossa a mano. Le righe con created_at NULL
+    vengono copiate con l'istante della migrazione.
+
+    Tutto avviene in un'unica transazione: dal RENAME al commit `transactions`
+    è bloccata in ACCESS EXCLUSIVE, quindi checkout e webhook restano fermi per
+    tutta la durata della copia. Va lanciata in una finestra di manutenzione.
+
+    Sul nuovo padre vengono riportati: vincoli CHECK/NOT NULL, default, GRANT,
+    RLS (enable/force e ogni policy), trigger non interni e appartenenza alle
+    publication (realtime). Non vengono riportati: indici secondari diversi da
+    (user_id, created_at), commenti, privilegi di colonna. Le partizioni hanno
+    RLS attiva senza policy e nessun grant ad anon/authenticated. Se la tabella
+    è referenziata da foreign key la migrazione si ferma con errore.
+    """
+    if is_partitioned():
+        return ensure_upcoming_partitions(ahead)
+
+    try:
+        _check_no_inbound_fks()
+        db.session.execute(text(f"ALTER TABLE {PARENT_TABLE} RENAME TO {LEGACY_TABLE}"))
+        # La PK di una tabella partizionata deve includere la chiave di partizione
+        db.session.execute(text(f"""
+            CREATE TABLE {PARENT_TABLE} (
+                LIKE {LEGACY_TABLE} INCLUDING DEFAULTS INCLUDING CONSTRAINTS,
+                PRIMARY KEY (id, created_at)
+            ) PARTITION BY RANGE (created_at)
+        """))
+        db.session.execute(text(f"ALTER TABLE {PARENT_TABLE} ALTER COLUMN created_at SET DEFAULT NOW()"))
+        db.session.execute(text(f"CREATE TABLE {DEFAULT_PARTITION} PARTITION OF {PARENT_TABLE} DEFAULT"))
+        _lock_down(DEFAULT_PARTITION)
+        db.session.execute(text(f"CREATE INDEX ON {PARENT_TABLE} (user_id, created_at)"))
+
+        bounds = db.session.execute(
+            text(f"SELECT MIN(created_at), MAX(created_at) FROM {LEGACY_TABLE}")
+        ).first()
+        created = []
+        last = add_months(month_start(date.today()), ahead)
+        month = month_start(bounds[0].date()) if bounds[0] else month_start(date.today())
+        if bounds[1]:
+            last = max(last, month_start(bounds[1].date()))
+        while month <= last:
+            ensure_partition(month)
+            created.append(partition_name(month))
+            month = add_months(month, 1)
+
+        # La PK include created_at: i NULL si normalizzano nella copia, la legacy
+        # resta intatta come backup
+        columns = db.session.execute(text("""
+            SELECT quote_ident(column_name) FROM information_schema.columns
+            WHERE table_schema = 'public' AND table_name = :table
+            ORDER BY ordinal_position
+        """), {"table": LEGACY_TABLE}).scalars().all()
+        select_list = ", ".join(
+            "COALESCE(created_at, NOW())" if c == "created_at" else c for c in columns
+        )
+        db.session.execute(text(
+            f"INSERT INTO {PARENT_TABLE} ({', '.join(columns)}) SELECT {select_list} FROM {LEGACY_TABLE}"
+        ))
+
+        # Sicurezza e side effect solo dopo la copia (i trigger non devono scattare sui dati migrati)
+        _copy_grants()
+        _copy_rls()
+        _copy_triggers()
+        _copy_publications()
+        db.session.execute(text("NOTIFY pgrst, 'reload schema'"))
+        db.session.commit()
+        return created
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+# -----------------------
+# Archiviazione dei mesi freddi su file CSV compressi
+# -----------------------
+# lock_not_available / deadlock_detected: il mese si riprova da capo
+RETRYABLE_PGCODES = ("55P03", "40P01")
+
+
+def _archive_month(name: str, path: str, drop: bool, lock_timeout_ms: int):
+    tmp_path = path + ".tmp"
+    try:
+        # lock_timeout sotto il deadlock_timeout di default (1s): se un UPDATE sul
+        # padre (es. webhook di stato) aspetta la nostra partizione, siamo noi a
+        # cedere e ritentare, non lui a essere scelto come vittima del deadlock.
+        db.session.execute(text(f"SET LOCAL lock_timeout = {int(lock_timeout_ms)}"))
+        db.session.execute(text(f"LOCK TABLE {name} IN SHARE MODE"))
+        # COPY sulla stessa connessione (e transazione) della sessione
+        cur = db.session.connection().connection.cursor()
+        try:
+            with gzip.open(tmp_path, "wt", encoding="utf-8", newline="") as fh:
+                cur.copy_expert(f"COPY (SELECT * FROM {name} ORDER BY created_at) TO STDOUT WITH CSV HEADER", fh)
+        finally:
+            cur.close()
+        db.session.execute(text(f"ALTER TABLE {PARENT_TABLE} DETACH PARTITION {name}"))
+        if drop:
+            db.session.execute(text(f"DROP TABLE {name}"))
+        # il file definitivo compare prima del commit: se il commit fallisce
+        # il mese resta attaccato e il file verrà sovrascritto al prossimo giro
+        os.replace(tmp_path, path)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def archive_partitions(older_than_months: int, archive_dir: str, drop: bool = False, today: date = None,
+                       lock_timeout_ms: int = 500, retries: int = 10) -> list:
+    """Esporta in `archive_dir` le partizioni più vecchie di N mesi e le stacca.
+
+    Ogni mese finisce in `transactions_YYYYMM.csv.gz` (CSV con header). Export
+    e DETACH avvengono nella stessa transazione, con la partizione bloccata in
+    SHARE MODE: nessun UPDATE (es. webhook di stato) può finire tra la copia e
+    il distacco. I lock hanno un `lock_timeout`: se scade il mese viene
+    ritentato (fino a `retries` volte). Con `drop=True` la tabella staccata
+    viene anche eliminata.
+    """
+    cutoff = add_months(month_start(today or date.today()), -older_than_months)
+    os.makedirs(archive_dir, exist_ok=True)
+    archived = []
+
+    for month in list_partitions():
+        if month >= cutoff:
+            continue
+        name = partition_name(month)
+        path = os.path.join(archive_dir, archive_file_name(month))
+        for attempt in range(retries + 1):
+            try:
+                _archive_month(name, path, drop, lock_timeout_ms)
+                break
+            except OperationalError as e:
+                if getattr(e.orig, "pgcode", None) not in RETRYABLE_PGCODES or attempt == retries:
+                    raise
+                time.sleep(min(0.2 * 2 ** attempt, 5))
+        archived.append(path)
+
+    return archived
+
+
+def archived_months(archive_dir: str) -> list:
+    months = []
+    for path in glob.glob(os.path.join(archive_dir, f"{PARENT_TABLE}_*.csv.gz")):
+        m = ARCHIVE_RE.match(os.path.basename(path))
+        if m:
+            months.append(date(int(m.group(1)), int(m.group(2)), 1))
+    return sorted(months)
+
+
+def _normalize_uuid(value):
+    try:
+        return str(UUID(str(value)))
+    except (TypeError, ValueError):
+        return None
+
+
+def read_archived_transactions(archive_dir: str, since: date, user_id: str = None) -> list:
+    """Legge le transazioni archiviate dal mese `since` in poi (opzionalmente di un solo utente).
+
+    Ogni file viene letto in streaming e filtrato riga per riga: in memoria
+    restano solo le righe restituite. `since` è obbligatorio per non
+    scansionare l'intero archivio a ogni richiesta.
+    """
+    key = _normalize_uuid(user_id) if user_id else None
+    if user_id and key is None:
+        return []
+    rows = []
+    for month in archived_months(archive_dir):
+        if month < month_start(since):
+            continue
+        path = os.path.join(archive_dir, archive_file_name(month))
+        with gzip.open(path, "rt", encoding="utf-8", newline="") as fh:
+            reader = csv.reader(fh)
+            header = next(reader, None)
+            if not header:
+                continue
+            user_col = header.index("user_id")
+            for values in reader:
+                # confronto veloce sul testo, normalizzazione UUID solo se serve
+                if key and values[user_col] != key and _normalize_uuid(values[user_col]) != key:
+                    continue
+                row = dict(zip(header, values))
+                row["archived"] = True
+                rows.append(row)
+    return rows
+
+
+# -----------------------
+# Formato unico per righe live (driver) e archiviate (testo COPY)
+# -----------------------
+def transaction_column_types() -> dict:
+    q = text("""
+        SELECT column_name, data_type FROM information_schema.columns
+        WHERE table_schema = 'public' AND table_name = :table
+    """)
+    return dict(db.session.execute(q, {"table": PARENT_TABLE}).all())
+
+
+def _live_value(value):
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return str(value)
+
+
+def _archived_value(raw: str, data_type: str):
+    # nel CSV di COPY il NULL è il campo vuoto
+    if raw == "":
+        return None
+    if data_type == "boolean":
+        return raw == "t"
+    if data_type.startswith("timestamp"):
+        return datetime.fromisoformat(raw).isoformat()
+    if data_type == "date":
+        return date.fromisoformat(raw).isoformat()
+    return raw
+
+
+def merge_transactions(live_rows, archived_rows: list, column_types: dict) -> list:
+    """Unisce righe live e archiviate nello stesso formato, senza duplicati per id.
+
+    Un mese può risultare sia archiviato sia ancora attaccato (file scritto ma
+    commit del DETACH fallito): in quel caso vince la riga live.
+    """
+    merged = {}
+    for row in live_rows:
+        out = {k: _live_value(v) for k, v in row.items()}
+        out["archived"] = False
+        merged[out["id"]] = out
+    for row in archived_rows:
+        if row.get("id") in merged:
+            continue
+        out = {k: _archived_value(v, column_types.get(k, "")) for k, v in row.items() if k != "archived"}
+        out["archived"] = True
+        merged[out["id"]] = out
+    return sorted(merged.values(), key=lambda r: r.get("created_at") or "")
+
+
+def rows_to_csv(rows: list) -> str:
+    if not rows:
+        return ""
+    fields = []
+    for row in rows:
+        for k in row.keys():
+            if k not in fields:
+                fields.append(k)
+    buf = io.StringIO()
+    writer = csv.DictWriter(buf, fieldnames=fields, extrasaction="ignore")
+    writer.writeheader()
+    for row in rows:
+        writer.writerow(row)
+    return buf.getvalue()
@@ -0,0 +1,208 @@
+import hashlib
+import json
+import threading
+import time
+from array import array
+from uuid import UUID
+
+from flask import current_app
+from sqlalchemy import text
+
+from db_routing import primary
+from models import db
+
+# -----------------------
+# Catalogo PSP in memoria di processo
+# -----------------------
+# Il catalogo PSP è minuscolo (una dozzina di righe): lo teniamo in memoria
+# con i nomi internati a piccoli interi (bit) e, per ogni merchant, una
+# bitmask dei PSP abilitati. Il controllo di abilitazione diventa un bit test
+# senza round trip al DB. La freschezza è garantita da un contatore di
+# versione (riga unica di catalog_version, incrementata da trigger su
+# psp_conditions e user_psp) letto al più ogni `ttl` secondi: le scritture su
+# user_psp arrivano anche dal client Supabase, quindi non basta invalidare
+# localmente. Il contatore si installa con `flask psp-catalog-install`.
+
+VERSION_TABLE = "catalog_version"
+VERSION_SQL = text(f"SELECT version FROM {VERSION_TABLE} WHERE id = 1")
+
+# SECURITY DEFINER: le scritture di anon/authenticated su user_psp devono poter
+# incrementare il contatore senza avere privilegi su catalog_version.
+INSTALL_SQL = [
+    f"""CREATE TABLE IF NOT EXISTS {VERSION_TABLE} (
+        id int PRIMARY KEY CHECK (id = 1),
+        version bigint NOT NULL DEFAULT 0
+    )""",
+    f"INSERT INTO {VERSION_TABLE} (id, version) VALUES (1, 0) ON CONFLICT (id) DO NOTHING",
+    f"ALTER TABLE {VERSION_TABLE} ENABLE ROW LEVEL SECURITY",
+    f"REVOKE ALL ON {VERSION_TABLE} FROM PUBLIC",
+    f"""CREATE OR REPLACE FUNCTION bump_catalog_version() RETURNS trigger
+        LANGUAGE plpgsql SECURITY DEFINER SET search_path = public AS $$
+        BEGIN
+            UPDATE {VERSION_TABLE} SET version = version + 1 WHERE id = 1;
+            RETURN NULL;
+        END
+    $$""",
+] + [
+    stmt
+    for table in ("psp_conditions", "user_psp")
+    for stmt in (
+        f"DROP TRIGGER IF EXISTS {table}_catalog_version ON {table}",
+        f"""CREATE TRIGGER {table}_catalog_version
+            AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {table}
+            FOR EACH STATEMENT EXECUTE FUNCTION bump_catalog_version()""",
+    )
+]
+
+
+def install_version_counter():
+    """Crea catalog_version e i trigger che la incrementano (idempotente)."""
+    try:
+        for stmt in INSTALL_SQL:
+            db.session.execute(text(stmt))
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+def _uuid_key(value):
+    """Normalizza un UUID (oggetto o stringa) in intero; None se non valido."""
+    if isinstance(value, UUID):
+        return value.int
+    try:
+        return UUID(str(value)).int
+    except (TypeError, ValueError, AttributeError):
+        return None
+
+
+class _Snapshot:
+    """Vista immutabile del catalogo: viene sostituita in blocco a ogni refresh."""
+
+    def __init__(self, version, psps, entitlements):
+        self.version = version
+        # psps: righe ordinate per psp_name -> il bit è la posizione
+        self.names = tuple(p["psp_name"] for p in psps)
+        self.bit_by_name = {name: i for i, name in enumerate(self.names)}
+        self.bit_by_id = {p["id"]: i for i, p in enumerate(psps)}
+        self.id_by_name = {p["psp_name"]: p["id"] for p in psps}
+
+        masks = {}
+        for user_id, psp_name in entitlements:
+            bit = self.bit_by_name.get(psp_name)
+            key = _uuid_key(user_id)
+            if bit is None or key is None:
+                continue
+            masks[key] = masks.get(key, 0) | (1 << bit)
+        # Mappa compatta merchant -> maschera: UUID ordinati spezzati in due
+        # array('Q') (parte alta/bassa) + maschere allineate, ~24 byte a merchant.
+        # Lookup con ricerca binaria, O(log n).
+        keys = sorted(masks)
+        self.user_hi = array("Q", (k >> 64 for k in keys))
+        self.user_lo = array("Q", (k & 0xFFFFFFFFFFFFFFFF for k in keys))
+        # array('Q') regge fino a 64 PSP; oltre si ripiega su una lista di int
+        values = (masks[k] for k in keys)
+        self.masks = array("Q", values) if len(self.names) <= 64 else list(values)
+
+        active = [{
+            "id": p["id"],
+            "psp_name": p["psp_name"],
+            "fixed_fee": float(p["fixed_fee"] or 0),
+            "percentage_fee": float(p["percentage_fee"] or 0),
+            "currency": p["currency"] or "EUR"
+        } for p in psps if p["active"]]
+        self.active_json = json.dumps(active, separators=(",", ":")).encode("utf-8")
+        self.etag = hashlib.sha1(self.active_json).hexdigest()
+
+    def mask_for(self, user_id) -> int:
+        key = _uuid_key(user_id)
+        if key is None:
+            return 0
+        hi, lo = key >> 64, key & 0xFFFFFFFFFFFFFFFF
+        left, right = 0, len(self.user_hi)
+        while left < right:
+            mid = (left + right) // 2
+            if (self.user_hi[mid], self.user_lo[mid]) < (hi, lo):
+                left = mid + 1
+            else:
+                right = mid
+        if left < len(self.user_hi) and self.user_hi[left] == hi and self.user_lo[left] == lo:
+            return self.masks[left]
+        return 0
+
+
+class PSPCatalog:
+    def __init__(self, ttl: float = 5.0):
+        self.ttl = ttl
+        self._snapshot = None
+        self._checked_at = 0.0
+        self._has_counter = None
+        self._lock = threading.Lock()
+
+    def _version(self):
+        """Versione corrente, oppure None se il contatore non è installato
+        (in quel caso il catalogo viene ricaricato a ogni scadenza del ttl)."""
+        if not self._has_counter:
+            # finché manca si ricontrolla a ogni ttl: l'install non richiede riavvio
+            found = bool(db.session.execute(
+                text("SELECT to_regclass(:table)"), {"table": f"public.{VERSION_TABLE}"}
+            ).scalar())
+            if not found and self._has_counter is None:
+                current_app.logger.error(
+                    "%s mancante: eseguire `flask psp-catalog-install`, "
+                    "nel frattempo il catalogo PSP si ricarica a ogni ttl", VERSION_TABLE
+                )
+            self._has_counter = found
+            if not found:
+                return None
+        return db.session.execute(VERSION_SQL).scalar()
+
+    def invalidate(self):
+        """Forza la verifica della versione alla prossima lettura."""
+        self._checked_at = 0.0
+
+    def snapshot(self) -> _Snapshot:
+        snap = self._snapshot
+        if snap is not None and time.monotonic() - self._checked_at < self.ttl:
+            return snap
+        with self._lock:
+            # un altro thread potrebbe aver già aggiornato mentre aspettavamo
+            if self._snapshot is not None and time.monotonic() - self._checked_at < self.ttl:
+                return self._snapshot
+            # Sempre dal primario, anche se la richiesta è su una replica: lo
+            # snapshot serve anche i controlli di abilitazione sul percorso di scrittura
+            with primary():
+                version = self._version()
+                if self._snapshot is None or version is None or self._snapshot.version != version:
+                    self._snapshot = self._load(version)
+            self._checked_at = time.monotonic()
+            return self._snapshot
+
+    def _load(self, version) -> _Snapshot:
+        psps = [
+            {**r, "id": str(r["id"])}
+            for r in db.session.execute(text("""
+                SELECT id, psp_name, fixed_fee, percentage_fee, currency, active
+                FROM psp_conditions ORDER BY psp_name
+            """)).mappings()
+        ]
+        entitlements = db.session.execute(text("SELECT user_id, psp_name FROM user_psp")).all()
+        return _Snapshot(version, psps, entitlements)
+
+    # -----------------------
+    # Lookup
+    # -----------------------
+    def psp_id_for(self, psp_name: str):
+        return self.snapshot().id_by_name.get(psp_name)
+
+    def is_enabled(self, user_id, psp_name: str = None, psp_id: str = None) -> bool:
+        """True se il merchant ha abilitato il PSP (per nome o per id di psp_conditions)."""
+        snap = self.snapshot()
+        if psp_name is not None:
+            bit = snap.bit_by_name.get(psp_name)
+        else:
+            key = _uuid_key(psp_id)
+            bit = snap.bit_by_id.get(str(UUID(int=key))) if key is not None else None
+        if bit is None:
+            return False
+        return bool(snap.mask_for(user_id) >> bit & 1)